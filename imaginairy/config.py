@@ -13,6 +13,8 @@ DEFAULT_NEGATIVE_PROMPT = (
 )
 
 SPLITMEM_ENABLED = False
+CUDA_GRAPHS_ENABLED = False
+CHANNELS_LAST_ENABLED = False
 
 
 @dataclass
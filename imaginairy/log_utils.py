@@ -9,6 +9,13 @@ _CURRENT_LOGGING_CONTEXT = None
 logger = logging.getLogger(__name__)
 
 
+def debug_images_enabled():
+    """Whether intermediate images are being captured for debugging."""
+    if _CURRENT_LOGGING_CONTEXT is None:
+        return False
+    return bool(_CURRENT_LOGGING_CONTEXT.debug_img_callback)
+
+
 def log_conditioning(conditioning, description):
     if _CURRENT_LOGGING_CONTEXT is None:
         return
@@ -293,9 +293,12 @@ class HybridConditioner(nn.Module):
         return {"c_concat": [c_concat], "c_crossattn": [c_crossattn]}
 
 
-def noise_like(shape, device, repeat=False):
+def noise_like(shape, device, repeat=False, out=None):
     if repeat:
-        return torch.randn((1, *shape[1:]), device=device).repeat(
-            shape[0], *((1,) * (len(shape) - 1))
-        )
+        noise = torch.randn((1, *shape[1:]), device=device)
+        if out is not None:
+            return out.copy_(noise)
+        return noise.repeat(shape[0], *((1,) * (len(shape) - 1)))
+    if out is not None:
+        return torch.randn(shape, out=out)
     return torch.randn(shape, device=device)
@@ -1,15 +1,20 @@
 # pylama:ignore=W0613
 import logging
+import weakref
 from abc import ABC
+from contextlib import nullcontext
+from typing import Optional
 
 import numpy as np
 import torch
 
-from imaginairy.log_utils import log_latent
+from imaginairy import config
+from imaginairy.log_utils import debug_images_enabled, log_latent
 from imaginairy.modules.diffusion.util import (
     extract_into_tensor,
     make_ddim_sampling_parameters,
     make_ddim_timesteps,
+    noise_like,
 )
 from imaginairy.utils import get_device
 
@@ -42,24 +47,157 @@ class ImageSampler(ABC):
         self.device = get_device()
 
 
+_cuda_graphed_funcs = weakref.WeakKeyDictionary()
+
+
+def get_denoise_func(model):
+    """
+    Return the model's denoising function, optimized for CUDA when enabled.
+
+    With `config.CUDA_GRAPHS_ENABLED` set it is replayed from a captured CUDA graph.
+    """
+    from imaginairy.modules.attention import XFORMERS_IS_AVAILABLE
+
+    if get_device() != "cuda":
+        return model.apply_model
+
+    # the non-xformers attention checks free memory, which can't be captured
+    if config.CUDA_GRAPHS_ENABLED and XFORMERS_IS_AVAILABLE:
+        # samplers are built per image, so keep the captured graph with the model.
+        # the graph bakes in the weights' addresses, re-capture if they move
+        weights_key = next(model.parameters()).data_ptr()
+        cached = _cuda_graphed_funcs.get(model)
+        if cached is None or cached[0] != weights_key:
+            # a weak reference so the cache doesn't keep the model alive
+            model_ref = weakref.ref(model)
+
+            def apply_model(*args):
+                return model_ref().apply_model(*args)
+
+            cached = (weights_key, CUDAGraphedFunc(apply_model))
+            _cuda_graphed_funcs[model] = cached
+        return cached[1]
+
+    return model.apply_model
+
+
+def _structure_key(obj):
+    if isinstance(obj, torch.Tensor):
+        return "tensor", obj.shape, obj.dtype, obj.device
+    if isinstance(obj, dict):
+        return "dict", tuple((k, _structure_key(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj).__name__, tuple(_structure_key(v) for v in obj)
+    return "value", repr(obj)
+
+
+def _flatten_tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        return [obj]
+    if isinstance(obj, dict):
+        return [t for v in obj.values() for t in _flatten_tensors(v)]
+    if isinstance(obj, (list, tuple)):
+        return [t for v in obj for t in _flatten_tensors(v)]
+    return []
+
+
+def _clone_tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.clone()
+    if isinstance(obj, dict):
+        return {k: _clone_tensors(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_clone_tensors(v) for v in obj)
+    return obj
+
+
+class CUDAGraphedFunc:
+    """
+    Replays a function from a captured CUDA graph.
+
+    Removes the python and kernel launch overhead of calling the function every
+    sampling step. The graph is captured on the first call and re-captured whenever
+    the structure of the arguments, the shapes of their tensors or the autocast state
+    change. Inputs are copied into static buffers before each replay.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.graph = None
+        self.graph_key = None
+        self.static_args = None
+        self.static_output = None
+
+    def __call__(self, *args):
+        tensors = _flatten_tensors(args)
+        key = (_structure_key(args), torch.is_autocast_enabled())
+        if key != self.graph_key:
+            self._capture(args)
+            self.graph_key = key
+        for static_t, t in zip(_flatten_tensors(self.static_args), tensors):
+            static_t.copy_(t)
+        self.graph.replay()
+        return self.static_output.clone()
+
+    def _capture(self, args):
+        self.static_args = _clone_tensors(args)
+        # cached autocast casts would be freed once the outer autocast exits
+        autocast_kwargs = {
+            "device_type": "cuda",
+            "enabled": torch.is_autocast_enabled(),
+            "cache_enabled": False,
+        }
+
+        # warmup on a side stream, as required before capture
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream), torch.autocast(**autocast_kwargs):
+            for _ in range(2):
+                self.func(*self.static_args)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), torch.autocast(**autocast_kwargs):
+            self.static_output = self.func(*self.static_args)
+
+
+def sampling_autocast(model):
+    """
+    Run the sampling loop in mixed precision if the model weights are half precision.
+
+    Otherwise any autocast state set by the caller is left alone. The step math stays
+    in float32 since the latents and schedule are float32.
+    """
+    if get_device() == "cuda" and next(model.parameters()).dtype == torch.float16:
+        return torch.autocast(device_type="cuda", dtype=torch.float16)
+    return nullcontext()
+
+
+def get_latent_memory_format():
+    """
+    Memory format to keep latents (and the diffusion model) in.
+
+    cuDNN has faster NHWC convolution kernels, other backends don't benefit. Enabled
+    with `config.CHANNELS_LAST_ENABLED` since the DDIM/PLMS samplers convert the
+    shared model, which the other samplers then feed contiguous latents.
+    """
+    if config.CHANNELS_LAST_ENABLED and get_device() == "cuda":
+        return torch.channels_last
+    return torch.contiguous_format
+
+
 def ensure_4_dim(t: torch.Tensor):
     if len(t.shape) == 3:
         t = t.unsqueeze(dim=0)
     return t
 
 
-def get_noise_prediction(
-    denoise_func,
-    noisy_latent,
-    time_encoding,
-    neutral_conditioning,
-    positive_conditioning,
-    signal_amplification=7.5,
-):
-    noisy_latent = ensure_4_dim(noisy_latent)
+def batch_conditioning(neutral_conditioning, positive_conditioning):
+    """
+    Stack neutral and positive conditioning along the batch dimension.
 
-    noisy_latent_in = torch.cat([noisy_latent] * 2)
-    time_encoding_in = torch.cat([time_encoding] * 2)
+    Lets both noise predictions come from a single forward pass of the model.
+    """
     if isinstance(positive_conditioning, dict):
         assert isinstance(neutral_conditioning, dict)
         conditioning_in = {}
@@ -75,11 +213,41 @@ def get_noise_prediction(
                 )
     else:
         conditioning_in = torch.cat([neutral_conditioning, positive_conditioning])
+    return conditioning_in
+
+
+def get_noise_prediction(
+    denoise_func,
+    noisy_latent,
+    time_encoding,
+    neutral_conditioning,
+    positive_conditioning,
+    signal_amplification=7.5,
+    batched_conditioning=None,
+):
+    """
+    Classifier-free guided noise prediction.
+
+    `batched_conditioning` may be passed (from `batch_conditioning`) to avoid
+    re-stacking the same conditioning every step.
+    """
+    noisy_latent = ensure_4_dim(noisy_latent)
+
+    if signal_amplification == 1:
+        # the neutral prediction cancels out, so skip computing it
+        return denoise_func(noisy_latent, time_encoding, positive_conditioning)
+
+    noisy_latent_in = torch.cat([noisy_latent] * 2)
+    time_encoding_in = torch.cat([time_encoding] * 2)
+    if batched_conditioning is None:
+        batched_conditioning = batch_conditioning(
+            neutral_conditioning, positive_conditioning
+        )
 
     # the k-diffusion samplers actually return the denoised predicted latents but things seem
     # to work anyway
     noise_pred_neutral, noise_pred_positive = denoise_func(
-        noisy_latent_in, time_encoding_in, conditioning_in
+        noisy_latent_in, time_encoding_in, batched_conditioning
     ).chunk(2)
 
     amplified_noise_pred = signal_amplification * (
@@ -105,24 +273,76 @@ def mask_blend(noisy_latent, orig_latent, mask, mask_noise, ts, model):
     # if we're in the first 10% of the steps then don't fully noise the parts
     # of the image we're not changing so that the algorithm can learn from the context
     if ts > 1000:
-        hinted_orig_latent = (
-            noised_orig_latent * (1 - hint_strength) + orig_latent * hint_strength
-        )
+        hinted_orig_latent = torch.lerp(noised_orig_latent, orig_latent, hint_strength)
         log_latent(hinted_orig_latent, f"hinted_orig_latent {ts}")
     else:
         hinted_orig_latent = noised_orig_latent
 
-    hinted_orig_latent_masked = hinted_orig_latent * mask
-    log_latent(hinted_orig_latent_masked, f"hinted_orig_latent_masked {ts}")
-    noisy_latent_masked = (1.0 - mask) * noisy_latent
-    log_latent(noisy_latent_masked, f"noisy_latent_masked {ts}")
-    noisy_latent = hinted_orig_latent_masked + noisy_latent_masked
+    # the masked halves are only materialized for the debug images
+    if debug_images_enabled():
+        log_latent(hinted_orig_latent * mask, f"hinted_orig_latent_masked {ts}")
+        log_latent((1.0 - mask) * noisy_latent, f"noisy_latent_masked {ts}")
+
+    # equivalent to `hinted_orig_latent * mask + (1.0 - mask) * noisy_latent`
+    # in a single kernel
+    noisy_latent = torch.lerp(noisy_latent, hinted_orig_latent, mask)
     log_latent(noisy_latent, f"mask-blended noisy_latent {ts}")
     return noisy_latent
 
 
+@torch.jit.script
+def ddim_predict_x0(noisy_latent, e_t, sqrt_one_minus_at, sqrt_at):
+    """Predict the denoised latent from the noise prediction (fused pointwise)."""
+    return (noisy_latent - sqrt_one_minus_at * e_t) / sqrt_at
+
+
+@torch.jit.script
+def ddim_x_prev(
+    predicted_latent, e_t, noise: Optional[torch.Tensor], sqrt_a_prev, dir_coeff
+):
+    """Step to the previous (less noisy) latent (fused pointwise)."""
+    x_prev = sqrt_a_prev * predicted_latent + dir_coeff * e_t
+    if noise is not None:
+        x_prev = x_prev + noise
+    return x_prev
+
+
+def _no_step_noise(sigma_t):
+    return None
+
+
+def make_step_noise_func(
+    schedule, latent, temperature=1.0, noise_dropout=0.0, repeat_noise=False
+):
+    """
+    Build the function returning the noise term of a ddim/plms step for sigma_t.
+
+    The variant is picked once per sampling run rather than branching every step. The
+    noise is drawn into a buffer reused across steps.
+    """
+    if schedule.sigma_is_zero:
+        return _no_step_noise
+
+    noise_buffer = torch.empty_like(latent)
+
+    def step_noise(sigma_t):
+        return noise_like(
+            latent.shape, latent.device, repeat_noise, out=noise_buffer
+        ).mul_(sigma_t * temperature)
+
+    if noise_dropout <= 0.0:
+        return step_noise
+
+    def step_noise_with_dropout(sigma_t):
+        return torch.nn.functional.dropout(step_noise(sigma_t), p=noise_dropout)
+
+    return step_noise_with_dropout
+
+
 def to_torch(x):
-    return x.clone().detach().to(torch.float32).to(get_device())
+    # no copy is made when x is already a float32 tensor on the device. that's fine
+    # since schedule tensors are never modified in place
+    return torch.as_tensor(x).detach().to(torch.float32).to(get_device())
 
 
 class NoiseSchedule:
@@ -138,12 +358,13 @@ class NoiseSchedule:
         if model_alphas_cumprod.shape[0] != model_num_timesteps:
             raise ValueError("alphas have to be defined for each timestep")
 
+        # a single device to host copy, reused for everything derived below
+        alphas_cumprod_cpu = model_alphas_cumprod.detach().cpu()
+
         self.alphas_cumprod = to_torch(model_alphas_cumprod)
         # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.sqrt_alphas_cumprod = to_torch(np.sqrt(model_alphas_cumprod.cpu()))
-        self.sqrt_one_minus_alphas_cumprod = to_torch(
-            np.sqrt(1.0 - model_alphas_cumprod.cpu())
-        )
+        self.sqrt_alphas_cumprod = to_torch(np.sqrt(alphas_cumprod_cpu))
+        self.sqrt_one_minus_alphas_cumprod = to_torch(np.sqrt(1.0 - alphas_cumprod_cpu))
 
         self.ddim_timesteps = make_ddim_timesteps(
             ddim_discr_method=ddim_discretize,
@@ -153,24 +374,66 @@ class NoiseSchedule:
 
         # ddim sampling parameters
         ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(
-            alphacums=model_alphas_cumprod.cpu(),
+            alphacums=alphas_cumprod_cpu,
             ddim_timesteps=self.ddim_timesteps,
             eta=ddim_eta,
         )
         self.ddim_sigmas = ddim_sigmas.to(torch.float32).to(device)
+        # with eta=0 sampling is deterministic and no noise needs to be drawn
+        self.sigma_is_zero = bool((self.ddim_sigmas == 0).all())
         self.ddim_alphas = ddim_alphas.to(torch.float32).to(device)
-        self.ddim_alphas_prev = ddim_alphas_prev
+        self.ddim_alphas_prev = (
+            torch.as_tensor(ddim_alphas_prev).to(torch.float32).to(device)
+        )
         self.ddim_sqrt_one_minus_alphas = (
             np.sqrt(1.0 - ddim_alphas).to(torch.float32).to(device)
         )
 
+        # per-step coefficients of the ddim update, indexed by step and broadcast
+        # against the latents
+        self.ddim_sqrt_alphas = self.ddim_alphas.sqrt()
+        self.ddim_sqrt_alphas_prev = self.ddim_alphas_prev.sqrt()
+        # direction pointing to x_t
+        self.ddim_dir_coeff = (1.0 - self.ddim_alphas_prev - self.ddim_sigmas**2).sqrt()
+
+
+_noise_schedule_cache = weakref.WeakKeyDictionary()
+
+
+def get_noise_schedule(model, num_steps, ddim_discretize="uniform", ddim_eta=0.0):
+    """
+    Return the model's noise schedule, reusing one already built with the same settings.
+
+    Schedules are cached per model and rebuilt if the model's alphas get reallocated
+    (for example when the model is moved to another device).
+    """
+    model_schedules = _noise_schedule_cache.setdefault(model, {})
+    key = (
+        model.alphas_cumprod.data_ptr(),
+        model.num_timesteps,
+        num_steps,
+        ddim_discretize,
+        ddim_eta,
+    )
+    if key not in model_schedules:
+        model_schedules[key] = NoiseSchedule(
+            model_num_timesteps=model.num_timesteps,
+            model_alphas_cumprod=model.alphas_cumprod,
+            ddim_num_steps=num_steps,
+            ddim_discretize=ddim_discretize,
+            ddim_eta=ddim_eta,
+        )
+    return model_schedules[key]
+
 
-@torch.no_grad()
+@torch.inference_mode()
 def noise_an_image(init_latent, t, schedule, noise=None):
     # fast, but does not allow for exact reconstruction
     # t serves as an index to gather the correct alphas
+    if isinstance(t, int):
+        t = torch.tensor([t], device=get_device())
     t = t.clamp(0, 1000)
-    sqrt_alphas_cumprod = torch.sqrt(schedule.ddim_alphas)
+    sqrt_alphas_cumprod = schedule.ddim_sqrt_alphas
     sqrt_one_minus_alphas_cumprod = schedule.ddim_sqrt_one_minus_alphas
 
     if noise is None:
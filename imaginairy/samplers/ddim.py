@@ -6,15 +6,21 @@ import torch
 from tqdm import tqdm
 
 from imaginairy.log_utils import increment_step, log_latent
-from imaginairy.modules.diffusion.util import extract_into_tensor, noise_like
 from imaginairy.samplers.base import (
     ImageSampler,
-    NoiseSchedule,
     SamplerName,
+    batch_conditioning,
+    ddim_predict_x0,
+    ddim_x_prev,
+    get_denoise_func,
+    get_latent_memory_format,
     get_noise_prediction,
+    get_noise_schedule,
+    make_step_noise_func,
     mask_blend,
+    noise_an_image,
+    sampling_autocast,
 )
-from imaginairy.utils import get_device
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +36,14 @@ class DDIMSampler(ImageSampler):
     name = "Denoising Diffusion Implicit Models"
     default_steps = 40
 
-    @torch.no_grad()
+    def __init__(self, model):
+        super().__init__(model)
+        self.denoise_func = get_denoise_func(model)
+        self.memory_format = get_latent_memory_format()
+        if self.memory_format == torch.channels_last and hasattr(model, "model"):
+            model.model.to(memory_format=self.memory_format)
+
+    @torch.inference_mode()
     def sample(
         self,
         num_steps,
@@ -48,21 +61,21 @@ class DDIMSampler(ImageSampler):
         quantize_x0=False,
         **kwargs,
     ):
-        schedule = NoiseSchedule(
-            model_num_timesteps=self.model.num_timesteps,
-            model_alphas_cumprod=self.model.alphas_cumprod,
-            ddim_num_steps=num_steps,
-            ddim_discretize="uniform",
-        )
+        schedule = get_noise_schedule(self.model, num_steps, ddim_discretize="uniform")
 
         if noise is None:
             noise = torch.randn(shape, device="cpu").to(self.device)
+        noise = noise.to(memory_format=self.memory_format)
+        if orig_latent is not None:
+            orig_latent = orig_latent.to(memory_format=self.memory_format)
+        if mask is not None:
+            mask = mask.to(memory_format=self.memory_format)
 
         log_latent(noise, "initial noise")
 
         timesteps = schedule.ddim_timesteps[:t_start]
 
-        time_range = np.flip(timesteps)
+        time_range = torch.from_numpy(np.flip(timesteps).copy()).long().to(self.device)
         total_steps = timesteps.shape[0]
 
         # t_start is none if init image strength set to 0
@@ -73,42 +86,58 @@ class DDIMSampler(ImageSampler):
         else:
             noisy_latent = noise
 
+        step_noise = make_step_noise_func(
+            schedule,
+            noisy_latent,
+            temperature=temperature,
+            noise_dropout=noise_dropout,
+        )
+
         mask_noise = None
         if mask is not None:
-            mask_noise = torch.randn_like(noisy_latent, device="cpu").to(
+            # drawn on the cpu so a seed gives the same result on every device
+            mask_noise = torch.randn(noisy_latent.shape, device="cpu").to(
                 noisy_latent.device
             )
 
-        for i, step in enumerate(tqdm(time_range, total=total_steps)):
-            index = total_steps - i - 1
-            ts = torch.full((batch_size,), step, device=self.device, dtype=torch.long)
+        # unused when guidance is off, since the neutral prediction is skipped
+        batched_conditioning = None
+        if guidance_scale != 1:
+            batched_conditioning = batch_conditioning(
+                neutral_conditioning, positive_conditioning
+            )
 
-            if mask is not None:
-                noisy_latent = mask_blend(
+        with sampling_autocast(self.model):
+            for i in tqdm(range(total_steps)):
+                index = total_steps - i - 1
+                ts = time_range[i].expand(batch_size)
+
+                if mask is not None:
+                    noisy_latent = mask_blend(
+                        noisy_latent=noisy_latent,
+                        orig_latent=orig_latent,
+                        mask=mask,
+                        mask_noise=mask_noise,
+                        ts=ts,
+                        model=self.model,
+                    )
+
+                noisy_latent, predicted_latent = self.p_sample_ddim(
                     noisy_latent=noisy_latent,
-                    orig_latent=orig_latent,
-                    mask=mask,
-                    mask_noise=mask_noise,
-                    ts=ts,
-                    model=self.model,
+                    neutral_conditioning=neutral_conditioning,
+                    positive_conditioning=positive_conditioning,
+                    guidance_scale=guidance_scale,
+                    batched_conditioning=batched_conditioning,
+                    time_encoding=ts,
+                    index=index,
+                    schedule=schedule,
+                    quantize_denoised=quantize_x0,
+                    step_noise=step_noise,
                 )
 
-            noisy_latent, predicted_latent = self.p_sample_ddim(
-                noisy_latent=noisy_latent,
-                neutral_conditioning=neutral_conditioning,
-                positive_conditioning=positive_conditioning,
-                guidance_scale=guidance_scale,
-                time_encoding=ts,
-                index=index,
-                schedule=schedule,
-                quantize_denoised=quantize_x0,
-                temperature=temperature,
-                noise_dropout=noise_dropout,
-            )
-
-            log_latent(noisy_latent, "noisy_latent")
-            log_latent(predicted_latent, "predicted_latent")
-            increment_step()
+                log_latent(noisy_latent, "noisy_latent")
+                log_latent(predicted_latent, "predicted_latent")
+                increment_step()
 
         return noisy_latent
 
@@ -126,15 +155,18 @@ class DDIMSampler(ImageSampler):
         temperature=1.0,
         noise_dropout=0.0,
         loss_function=None,
+        batched_conditioning=None,
+        step_noise=None,
     ):
         assert guidance_scale >= 1
         noise_pred = get_noise_prediction(
-            denoise_func=self.model.apply_model,
+            denoise_func=self.denoise_func,
             noisy_latent=noisy_latent,
             time_encoding=time_encoding,
             neutral_conditioning=neutral_conditioning,
             positive_conditioning=positive_conditioning,
             signal_amplification=guidance_scale,
+            batched_conditioning=batched_conditioning,
         )
 
         if self.model.parameterization == "v":
@@ -144,29 +176,21 @@ class DDIMSampler(ImageSampler):
         else:
             e_t = noise_pred
 
-        batch_size = noisy_latent.shape[0]
+        if step_noise is None:
+            step_noise = make_step_noise_func(
+                schedule,
+                noisy_latent,
+                temperature=temperature,
+                noise_dropout=noise_dropout,
+                repeat_noise=repeat_noise,
+            )
 
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full(
-            (batch_size, 1, 1, 1),
-            schedule.ddim_alphas[index],
-            device=noisy_latent.device,
-        )
-        a_prev = torch.full(
-            (batch_size, 1, 1, 1),
-            schedule.ddim_alphas_prev[index],
-            device=noisy_latent.device,
-        )
-        sigma_t = torch.full(
-            (batch_size, 1, 1, 1),
-            schedule.ddim_sigmas[index],
-            device=noisy_latent.device,
-        )
-        sqrt_one_minus_at = torch.full(
-            (batch_size, 1, 1, 1),
-            schedule.ddim_sqrt_one_minus_alphas[index],
-            device=noisy_latent.device,
-        )
+        sqrt_at = schedule.ddim_sqrt_alphas[index]
+        sqrt_a_prev = schedule.ddim_sqrt_alphas_prev[index]
+        sigma_t = schedule.ddim_sigmas[index]
+        sqrt_one_minus_at = schedule.ddim_sqrt_one_minus_alphas[index]
+        dir_coeff = schedule.ddim_dir_coeff[index]
 
         noisy_latent, predicted_latent = self._p_sample_ddim_formula(
             model=self.model,
@@ -174,13 +198,12 @@ class DDIMSampler(ImageSampler):
             noise_pred=noise_pred,
             e_t=e_t,
             sqrt_one_minus_at=sqrt_one_minus_at,
-            a_t=a_t,
+            sqrt_at=sqrt_at,
             time_encoding=time_encoding,
             sigma_t=sigma_t,
-            a_prev=a_prev,
-            noise_dropout=noise_dropout,
-            repeat_noise=repeat_noise,
-            temperature=temperature,
+            sqrt_a_prev=sqrt_a_prev,
+            dir_coeff=dir_coeff,
+            step_noise=step_noise,
         )
         return noisy_latent, predicted_latent
 
@@ -191,44 +214,25 @@ class DDIMSampler(ImageSampler):
         noise_pred,
         e_t,
         sqrt_one_minus_at,
-        a_t,
+        sqrt_at,
         time_encoding,
         sigma_t,
-        a_prev,
-        noise_dropout,
-        repeat_noise,
-        temperature,
+        sqrt_a_prev,
+        dir_coeff,
+        step_noise,
     ):
         if model.parameterization != "v":
-            predicted_latent = (noisy_latent - sqrt_one_minus_at * e_t) / a_t.sqrt()
+            predicted_latent = ddim_predict_x0(
+                noisy_latent, e_t, sqrt_one_minus_at, sqrt_at
+            )
         else:
             predicted_latent = model.predict_start_from_z_and_v(
                 noisy_latent, time_encoding, noise_pred
             )
-        # direction pointing to x_t
-        dir_xt = (1.0 - a_prev - sigma_t**2).sqrt() * e_t
-        noise = (
-            sigma_t
-            * noise_like(noisy_latent.shape, noisy_latent.device, repeat_noise)
-            * temperature
-        )
-        if noise_dropout > 0.0:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * predicted_latent + dir_xt + noise
+        noise = step_noise(sigma_t)
+        x_prev = ddim_x_prev(predicted_latent, e_t, noise, sqrt_a_prev, dir_coeff)
         return x_prev, predicted_latent
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def noise_an_image(self, init_latent, t, schedule, noise=None):
-        if isinstance(t, int):
-            t = torch.tensor([t], device=get_device())
-        t = t.clamp(0, 1000)
-        sqrt_alphas_cumprod = torch.sqrt(schedule.ddim_alphas)
-        sqrt_one_minus_alphas_cumprod = schedule.ddim_sqrt_one_minus_alphas
-
-        if noise is None:
-            noise = torch.randn_like(init_latent, device="cpu").to(get_device())
-        return (
-            extract_into_tensor(sqrt_alphas_cumprod, t, init_latent.shape) * init_latent
-            + extract_into_tensor(sqrt_one_minus_alphas_cumprod, t, init_latent.shape)
-            * noise
-        )
+        return noise_an_image(init_latent, t, schedule, noise=noise)
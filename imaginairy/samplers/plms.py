@@ -6,19 +6,48 @@ import torch
 from tqdm import tqdm
 
 from imaginairy.log_utils import increment_step, log_latent
-from imaginairy.modules.diffusion.util import extract_into_tensor, noise_like
 from imaginairy.samplers.base import (
     ImageSampler,
     NoiseSchedule,
     SamplerName,
+    batch_conditioning,
+    ddim_predict_x0,
+    ddim_x_prev,
+    get_denoise_func,
+    get_latent_memory_format,
     get_noise_prediction,
+    get_noise_schedule,
+    make_step_noise_func,
     mask_blend,
+    noise_an_image,
+    sampling_autocast,
 )
-from imaginairy.utils import get_device
 
 logger = logging.getLogger(__name__)
 
 
+# linear multistep combinations of noise predictions, scripted so each fuses into
+# a single kernel
+@torch.jit.script
+def improved_euler_eps(e_t, e_t_next):
+    return (e_t + e_t_next) / 2
+
+
+@torch.jit.script
+def adams_bashforth_2_eps(e_t, e_t_1):
+    return (3 * e_t - e_t_1) / 2
+
+
+@torch.jit.script
+def adams_bashforth_3_eps(e_t, e_t_1, e_t_2):
+    return (23 * e_t - 16 * e_t_1 + 5 * e_t_2) / 12
+
+
+@torch.jit.script
+def adams_bashforth_4_eps(e_t, e_t_1, e_t_2, e_t_3):
+    return (55 * e_t - 59 * e_t_1 + 37 * e_t_2 - 9 * e_t_3) / 24
+
+
 class PLMSSampler(ImageSampler):
     """
     probabilistic least-mean-squares.
@@ -33,7 +62,14 @@ class PLMSSampler(ImageSampler):
     name = "probabilistic least-mean-squares sampler"
     default_steps = 40
 
-    @torch.no_grad()
+    def __init__(self, model):
+        super().__init__(model)
+        self.denoise_func = get_denoise_func(model)
+        self.memory_format = get_latent_memory_format()
+        if self.memory_format == torch.channels_last and hasattr(model, "model"):
+            model.model.to(memory_format=self.memory_format)
+
+    @torch.inference_mode()
     def sample(
         self,
         num_steps,
@@ -56,22 +92,25 @@ class PLMSSampler(ImageSampler):
         #         f"Got {positive_conditioning.shape[0]} conditionings but batch-size is {batch_size}"
         #     )
 
-        schedule = NoiseSchedule(
-            model_num_timesteps=self.model.num_timesteps,
-            ddim_num_steps=num_steps,
-            model_alphas_cumprod=self.model.alphas_cumprod,
-            ddim_discretize="uniform",
+        schedule = get_noise_schedule(
+            self.model, num_steps, ddim_discretize="uniform", ddim_eta=0.0
         )
 
         if noise is None:
             noise = torch.randn(shape, device="cpu").to(self.device)
+        noise = noise.to(memory_format=self.memory_format)
+        if orig_latent is not None:
+            orig_latent = orig_latent.to(memory_format=self.memory_format)
+        if mask is not None:
+            mask = mask.to(memory_format=self.memory_format)
 
         log_latent(noise, "initial noise")
 
         timesteps = schedule.ddim_timesteps[:t_start]
 
-        time_range = np.flip(timesteps)
+        time_range = torch.from_numpy(np.flip(timesteps).copy()).long().to(self.device)
         total_steps = timesteps.shape[0]
+        next_time_range = torch.cat([time_range[1:], time_range[-1:]])
 
         old_eps = []
 
@@ -83,57 +122,68 @@ class PLMSSampler(ImageSampler):
         else:
             noisy_latent = noise
 
+        step_noise = make_step_noise_func(
+            schedule,
+            noisy_latent,
+            temperature=temperature,
+            noise_dropout=noise_dropout,
+        )
+
         mask_noise = None
         if mask is not None:
-            mask_noise = torch.randn_like(noisy_latent, device="cpu").to(
+            # drawn on the cpu so a seed gives the same result on every device
+            mask_noise = torch.randn(noisy_latent.shape, device="cpu").to(
                 noisy_latent.device
             )
 
-        for i, step in enumerate(tqdm(time_range, total=total_steps)):
-            index = total_steps - i - 1
-            ts = torch.full((batch_size,), step, device=self.device, dtype=torch.long)
-            ts_next = torch.full(
-                (batch_size,),
-                time_range[min(i + 1, len(time_range) - 1)],
-                device=self.device,
-                dtype=torch.long,
+        # unused when guidance is off, since the neutral prediction is skipped
+        batched_conditioning = None
+        if guidance_scale != 1:
+            batched_conditioning = batch_conditioning(
+                neutral_conditioning, positive_conditioning
             )
 
-            if mask is not None:
-                noisy_latent = mask_blend(
+        with sampling_autocast(self.model):
+            for i in tqdm(range(total_steps)):
+                index = total_steps - i - 1
+                ts = time_range[i].expand(batch_size)
+                ts_next = next_time_range[i].expand(batch_size)
+
+                if mask is not None:
+                    noisy_latent = mask_blend(
+                        noisy_latent=noisy_latent,
+                        orig_latent=orig_latent,
+                        mask=mask,
+                        mask_noise=mask_noise,
+                        ts=ts,
+                        model=self.model,
+                    )
+
+                noisy_latent, predicted_latent, noise_pred = self.p_sample_plms(
                     noisy_latent=noisy_latent,
-                    orig_latent=orig_latent,
-                    mask=mask,
-                    mask_noise=mask_noise,
-                    ts=ts,
-                    model=self.model,
+                    neutral_conditioning=neutral_conditioning,
+                    positive_conditioning=positive_conditioning,
+                    guidance_scale=guidance_scale,
+                    batched_conditioning=batched_conditioning,
+                    time_encoding=ts,
+                    schedule=schedule,
+                    index=index,
+                    quantize_denoised=quantize_denoised,
+                    step_noise=step_noise,
+                    old_eps=old_eps,
+                    t_next=ts_next,
                 )
+                old_eps.append(noise_pred)
+                if len(old_eps) >= 4:
+                    old_eps.pop(0)
 
-            noisy_latent, predicted_latent, noise_pred = self.p_sample_plms(
-                noisy_latent=noisy_latent,
-                neutral_conditioning=neutral_conditioning,
-                positive_conditioning=positive_conditioning,
-                guidance_scale=guidance_scale,
-                time_encoding=ts,
-                schedule=schedule,
-                index=index,
-                quantize_denoised=quantize_denoised,
-                temperature=temperature,
-                noise_dropout=noise_dropout,
-                old_eps=old_eps,
-                t_next=ts_next,
-            )
-            old_eps.append(noise_pred)
-            if len(old_eps) >= 4:
-                old_eps.pop(0)
-
-            log_latent(noisy_latent, "noisy_latent")
-            log_latent(predicted_latent, "predicted_latent")
-            increment_step()
+                log_latent(noisy_latent, "noisy_latent")
+                log_latent(predicted_latent, "predicted_latent")
+                increment_step()
 
         return noisy_latent
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def p_sample_plms(
         self,
         noisy_latent,
@@ -149,95 +199,104 @@ class PLMSSampler(ImageSampler):
         noise_dropout=0.0,
         old_eps=None,
         t_next=None,
+        batched_conditioning=None,
+        step_noise=None,
     ):
         assert guidance_scale >= 1
         noise_pred = get_noise_prediction(
-            denoise_func=self.model.apply_model,
+            denoise_func=self.denoise_func,
             noisy_latent=noisy_latent,
             time_encoding=time_encoding,
             neutral_conditioning=neutral_conditioning,
             positive_conditioning=positive_conditioning,
             signal_amplification=guidance_scale,
+            batched_conditioning=batched_conditioning,
         )
-        batch_size = noisy_latent.shape[0]
 
-        def get_x_prev_and_pred_x0(e_t, index):
-            # select parameters corresponding to the currently considered timestep
-            alpha_at_t = torch.full(
-                (batch_size, 1, 1, 1), schedule.ddim_alphas[index], device=self.device
-            )
-            alpha_prev_at_t = torch.full(
-                (batch_size, 1, 1, 1),
-                schedule.ddim_alphas_prev[index],
-                device=self.device,
-            )
-            sigma_t = torch.full(
-                (batch_size, 1, 1, 1), schedule.ddim_sigmas[index], device=self.device
-            )
-            sqrt_one_minus_at = torch.full(
-                (batch_size, 1, 1, 1),
-                schedule.ddim_sqrt_one_minus_alphas[index],
-                device=self.device,
+        if step_noise is None:
+            step_noise = make_step_noise_func(
+                schedule,
+                noisy_latent,
+                temperature=temperature,
+                noise_dropout=noise_dropout,
+                repeat_noise=repeat_noise,
             )
 
-            # current prediction for x_0
-            pred_x0 = (noisy_latent - sqrt_one_minus_at * e_t) / alpha_at_t.sqrt()
-            if quantize_denoised:
-                pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
-            # direction pointing to x_t
-            dir_xt = (1.0 - alpha_prev_at_t - sigma_t**2).sqrt() * e_t
-            noise = (
-                sigma_t
-                * noise_like(noisy_latent.shape, self.device, repeat_noise)
-                * temperature
-            )
-            if noise_dropout > 0.0:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = alpha_prev_at_t.sqrt() * pred_x0 + dir_xt + noise
-            return x_prev, pred_x0
+        # select parameters corresponding to the currently considered timestep
+        step_coefficients = {
+            "sqrt_one_minus_at": schedule.ddim_sqrt_one_minus_alphas[index],
+            "sqrt_at": schedule.ddim_sqrt_alphas[index],
+            "sigma_t": schedule.ddim_sigmas[index],
+            "sqrt_a_prev": schedule.ddim_sqrt_alphas_prev[index],
+            "dir_coeff": schedule.ddim_dir_coeff[index],
+        }
 
         if len(old_eps) == 0:
             # Pseudo Improved Euler (2nd order)
-            x_prev, pred_x0 = get_x_prev_and_pred_x0(noise_pred, index)
+            x_prev, pred_x0 = self._p_sample_plms_formula(
+                model=self.model,
+                noisy_latent=noisy_latent,
+                e_t=noise_pred,
+                step_noise=step_noise,
+                quantize_denoised=quantize_denoised,
+                **step_coefficients,
+            )
             e_t_next = get_noise_prediction(
-                denoise_func=self.model.apply_model,
+                denoise_func=self.denoise_func,
                 noisy_latent=x_prev,
                 time_encoding=t_next,
                 neutral_conditioning=neutral_conditioning,
                 positive_conditioning=positive_conditioning,
                 signal_amplification=guidance_scale,
+                batched_conditioning=batched_conditioning,
             )
-            e_t_prime = (noise_pred + e_t_next) / 2
+            e_t_prime = improved_euler_eps(noise_pred, e_t_next)
         elif len(old_eps) == 1:
             # 2nd order Pseudo Linear Multistep (Adams-Bashforth)
-            e_t_prime = (3 * noise_pred - old_eps[-1]) / 2
+            e_t_prime = adams_bashforth_2_eps(noise_pred, old_eps[-1])
         elif len(old_eps) == 2:
             # 3rd order Pseudo Linear Multistep (Adams-Bashforth)
-            e_t_prime = (23 * noise_pred - 16 * old_eps[-1] + 5 * old_eps[-2]) / 12
+            e_t_prime = adams_bashforth_3_eps(noise_pred, old_eps[-1], old_eps[-2])
         elif len(old_eps) >= 3:
             # 4nd order Pseudo Linear Multistep (Adams-Bashforth)
-            e_t_prime = (
-                55 * noise_pred - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]
-            ) / 24
+            e_t_prime = adams_bashforth_4_eps(
+                noise_pred, old_eps[-1], old_eps[-2], old_eps[-3]
+            )
 
-        x_prev, pred_x0 = get_x_prev_and_pred_x0(e_t_prime, index)
+        x_prev, pred_x0 = self._p_sample_plms_formula(
+            model=self.model,
+            noisy_latent=noisy_latent,
+            e_t=e_t_prime,
+            step_noise=step_noise,
+            quantize_denoised=quantize_denoised,
+            **step_coefficients,
+        )
         log_latent(x_prev, "x_prev")
         log_latent(pred_x0, "pred_x0")
 
         return x_prev, pred_x0, noise_pred
 
-    @torch.no_grad()
-    def noise_an_image(self, init_latent, t, schedule, noise=None):
-        if isinstance(t, int):
-            t = torch.tensor([t], device=get_device())
-        t = t.clamp(0, 1000)
-        sqrt_alphas_cumprod = torch.sqrt(schedule.ddim_alphas)
-        sqrt_one_minus_alphas_cumprod = schedule.ddim_sqrt_one_minus_alphas
+    @staticmethod
+    def _p_sample_plms_formula(
+        model,
+        noisy_latent,
+        e_t,
+        sqrt_one_minus_at,
+        sqrt_at,
+        sigma_t,
+        sqrt_a_prev,
+        dir_coeff,
+        step_noise,
+        quantize_denoised,
+    ):
+        # current prediction for x_0
+        pred_x0 = ddim_predict_x0(noisy_latent, e_t, sqrt_one_minus_at, sqrt_at)
+        if quantize_denoised:
+            pred_x0, _, *_ = model.first_stage_model.quantize(pred_x0)
+        noise = step_noise(sigma_t)
+        x_prev = ddim_x_prev(pred_x0, e_t, noise, sqrt_a_prev, dir_coeff)
+        return x_prev, pred_x0
 
-        if noise is None:
-            noise = torch.randn_like(init_latent, device="cpu").to(get_device())
-        return (
-            extract_into_tensor(sqrt_alphas_cumprod, t, init_latent.shape) * init_latent
-            + extract_into_tensor(sqrt_one_minus_alphas_cumprod, t, init_latent.shape)
-            * noise
-        )
+    @torch.inference_mode()
+    def noise_an_image(self, init_latent, t, schedule, noise=None):
+        return noise_an_image(init_latent, t, schedule, noise=noise)
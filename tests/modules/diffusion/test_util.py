@@ -0,0 +1,20 @@
+import torch
+
+from imaginairy.modules.diffusion.util import noise_like
+
+
+def test_noise_like_out():
+    out = torch.empty(3, 4, 8, 8)
+    noise = noise_like(out.shape, "cpu", out=out)
+
+    assert noise is out
+    assert not torch.equal(noise[0], noise[1])
+
+
+def test_noise_like_out_repeat():
+    out = torch.empty(3, 4, 8, 8)
+    noise = noise_like(out.shape, "cpu", repeat=True, out=out)
+
+    assert noise is out
+    assert torch.equal(noise[0], noise[1])
+    assert torch.equal(noise[0], noise[2])
@@ -1,6 +1,12 @@
 import pytest
 import torch
 
+from imaginairy.samplers.base import (
+    CUDAGraphedFunc,
+    get_noise_schedule,
+    make_step_noise_func,
+    mask_blend,
+)
 from imaginairy.utils import get_device
 
 
@@ -18,3 +24,132 @@ def test_sigma_bug():
 
     for i in range(sigmas.size()[0]):
         assert t_fn_a(sigmas[i]) == t_fn_b(sigmas[i])
+
+
+class FakeDiffusionModel:
+    num_timesteps = 1000
+
+    def __init__(self):
+        betas = torch.linspace(0.00085, 0.012, self.num_timesteps, dtype=torch.float64)
+        alphas_cumprod = torch.cumprod(1.0 - betas, dim=0).to(torch.float32)
+        self.alphas_cumprod = alphas_cumprod.to(get_device())
+
+
+def test_noise_schedule_cached():
+    model = FakeDiffusionModel()
+    schedule = get_noise_schedule(model, num_steps=20)
+
+    assert get_noise_schedule(model, num_steps=20) is schedule
+    assert get_noise_schedule(model, num_steps=30) is not schedule
+    assert get_noise_schedule(FakeDiffusionModel(), num_steps=20) is not schedule
+
+
+@pytest.mark.parametrize("ddim_eta", [0.0, 0.5])
+def test_noise_schedule_step_coefficients(ddim_eta):
+    model = FakeDiffusionModel()
+    schedule = get_noise_schedule(model, num_steps=20, ddim_eta=ddim_eta)
+
+    # computed independently, in float64, from the ddim paper's formulas
+    alphas_cumprod = model.alphas_cumprod.cpu().to(torch.float64)
+    timesteps = torch.arange(0, 1000, 50) + 1
+    alphas = alphas_cumprod[timesteps]
+    alphas_prev = torch.cat([alphas_cumprod[:1], alphas[:-1]])
+    sigmas = (
+        ddim_eta
+        * ((1 - alphas_prev) / (1 - alphas) * (1 - alphas / alphas_prev)).sqrt()
+    )
+    dir_coeff = (1 - alphas_prev - sigmas**2).sqrt()
+
+    def assert_close(schedule_values, expected):
+        assert torch.allclose(
+            schedule_values.cpu().to(torch.float64), expected, atol=1e-5
+        )
+
+    assert_close(schedule.ddim_dir_coeff, dir_coeff)
+    assert_close(schedule.ddim_sqrt_alphas, alphas.sqrt())
+    assert_close(schedule.ddim_sqrt_alphas_prev, alphas_prev.sqrt())
+    assert schedule.sigma_is_zero == (ddim_eta == 0.0)
+
+
+@pytest.mark.skipif(get_device() != "cuda", reason="CUDA graphs need cuda")
+def test_cuda_graphed_func_matches_eager():
+    linear = torch.nn.Linear(8, 8).to("cuda")
+
+    def func(x, t, cond):
+        out = linear(x) * t[:, None]
+        for key, tensors in cond.items():
+            out = out + tensors[0] * len(key)
+        return out
+
+    graphed_func = CUDAGraphedFunc(func)
+    conds = [
+        {"c_crossattn": [torch.randn(2, 8, device="cuda")]},
+        {"c_crossattn": [torch.randn(2, 8, device="cuda")]},
+        # same tensor shapes, different structure
+        {"c_concat": [torch.randn(2, 8, device="cuda")]},
+    ]
+    with torch.no_grad():
+        for cond in conds:
+            x = torch.randn(2, 8, device="cuda")
+            t = torch.rand(2, device="cuda")
+            expected = func(x, t, cond)
+            result = graphed_func(x, t, cond)
+            assert torch.allclose(result, expected, atol=1e-5)
+
+
+class FakeMaskModel:
+    def q_sample(self, x_start, t, noise):
+        return x_start + noise
+
+
+@pytest.mark.parametrize("ts", [500, 1001])
+def test_mask_blend(ts):
+    orig_latent = torch.randn(1, 4, 8, 8)
+    noisy_latent = torch.randn(1, 4, 8, 8)
+    mask_noise = torch.randn(1, 4, 8, 8)
+    mask = torch.rand(1, 1, 8, 8)
+    mask[..., :4] = 0
+    mask[..., -2:] = 1
+
+    blended = mask_blend(
+        noisy_latent=noisy_latent,
+        orig_latent=orig_latent,
+        mask=mask,
+        mask_noise=mask_noise,
+        ts=torch.tensor([ts]),
+        model=FakeMaskModel(),
+    )
+
+    hinted_orig_latent = orig_latent if ts > 1000 else orig_latent + mask_noise
+    expected = hinted_orig_latent * mask + (1.0 - mask) * noisy_latent
+    assert torch.allclose(blended, expected, atol=1e-5)
+
+
+def test_step_noise_sigma_zero():
+    schedule = get_noise_schedule(FakeDiffusionModel(), num_steps=20, ddim_eta=0.0)
+    step_noise = make_step_noise_func(schedule, torch.zeros(1, 4, 8, 8))
+
+    assert step_noise(torch.tensor(0.0)) is None
+
+
+def test_step_noise_dropout_keeps_buffer(monkeypatch):
+    dropout_inputs = []
+    dropout = torch.nn.functional.dropout
+
+    def spy_dropout(noise, *args, **kwargs):
+        dropout_inputs.append((noise, noise.clone()))
+        return dropout(noise, *args, **kwargs)
+
+    monkeypatch.setattr(torch.nn.functional, "dropout", spy_dropout)
+
+    schedule = get_noise_schedule(FakeDiffusionModel(), num_steps=20, ddim_eta=0.5)
+    step_noise = make_step_noise_func(
+        schedule, torch.zeros(1, 4, 8, 8), noise_dropout=0.5
+    )
+    dropped_noise = step_noise(torch.tensor(0.5))
+
+    ((noise_buffer, noise_before_dropout),) = dropout_inputs
+    assert dropped_noise is not noise_buffer
+    assert torch.equal(noise_buffer, noise_before_dropout)
+    assert (dropped_noise == 0).any()
+    assert not (noise_buffer == 0).any()
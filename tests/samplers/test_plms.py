@@ -0,0 +1,53 @@
+import torch
+
+from imaginairy.samplers import plms
+from imaginairy.samplers.plms import PLMSSampler
+from imaginairy.utils import get_device
+
+
+class CountingDiffusionModel(torch.nn.Module):
+    """Predicts noise filled with the number of times it has been called."""
+
+    num_timesteps = 1000
+
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(1))
+        betas = torch.linspace(0.00085, 0.012, self.num_timesteps, dtype=torch.float64)
+        alphas_cumprod = torch.cumprod(1.0 - betas, dim=0).to(torch.float32)
+        self.alphas_cumprod = alphas_cumprod.to(get_device())
+        self.calls = 0
+
+    def apply_model(self, x_noisy, t, cond):
+        self.calls += 1
+        return torch.full_like(x_noisy, float(self.calls))
+
+
+def test_plms_uses_newest_noise_predictions(monkeypatch):
+    multistep_eps = []
+
+    def spy_adams_bashforth_4_eps(e_t, e_t_1, e_t_2, e_t_3):
+        multistep_eps.append(
+            tuple(e.flatten()[0].item() for e in (e_t, e_t_1, e_t_2, e_t_3))
+        )
+        return e_t
+
+    monkeypatch.setattr(plms, "adams_bashforth_4_eps", spy_adams_bashforth_4_eps)
+
+    cond = torch.zeros(1, 1, device=get_device())
+    PLMSSampler(CountingDiffusionModel()).sample(
+        num_steps=8,
+        shape=(1, 4, 8, 8),
+        neutral_conditioning=cond,
+        positive_conditioning=cond,
+        guidance_scale=1.0,
+    )
+
+    # the first step predicts twice (calls 1 and 2) and keeps the first prediction
+    assert multistep_eps == [
+        (5, 4, 3, 1),
+        (6, 5, 4, 3),
+        (7, 6, 5, 4),
+        (8, 7, 6, 5),
+        (9, 8, 7, 6),
+    ]